@@ -2,41 +2,74 @@ from __future__ import annotations
 
 import argparse
 import csv
+import heapq
+import io
 import statistics
+import sys
 from collections import defaultdict
 from dataclasses import dataclass
-from datetime import date, datetime, timedelta
+from datetime import date, datetime
 from itertools import permutations, product
-from typing import Dict, Iterable, List, Optional, Tuple
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 
 # ==============================
 # Data models
 # ==============================
 
 
-@dataclass(frozen=True)
 class FlightOption:
     """Represents a single flight option for a specific origin/destination on a given date.
 
     All money values are assumed to be USD. Dates are local calendar dates (no times).
     Stops should be the count of intermediate stops. Nonstop = 0 stops.
     Duration is optional (minutes). Unknown durations are treated as 0 only for tie-breaking.
+
+    A plain slotted class rather than a dataclass: the search reads price/duration in its
+    inner loop, and slot descriptors keep those reads cheap and instances small.
     """
 
-    origin_city: str
-    destination_city: str
-    date: date
-    price: float
-    stops: int
-    duration_minutes: int = 0
-    airline: str = ""
-    booking_link: str = ""
+    __slots__ = (
+        "origin_city",
+        "destination_city",
+        "date",
+        "price",
+        "stops",
+        "duration_minutes",
+        "airline",
+        "booking_link",
+    )
+
+    def __init__(
+        self,
+        origin_city: str,
+        destination_city: str,
+        date: date,
+        price: float,
+        stops: int,
+        duration_minutes: int = 0,
+        airline: str = "",
+        booking_link: str = "",
+    ) -> None:
+        self.origin_city = origin_city
+        self.destination_city = destination_city
+        self.date = date
+        self.price = price
+        self.stops = stops
+        self.duration_minutes = duration_minutes
+        self.airline = airline
+        self.booking_link = booking_link
+
+    def __repr__(self) -> str:
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"FlightOption({fields})"
 
 
 @dataclass
 class Segment:
     """A flown segment in an itinerary (chosen flight)."""
 
+    __slots__ = ("origin_city", "destination_city", "depart_date", "arrive_date", "flight")
+
     origin_city: str
     destination_city: str
     depart_date: date
@@ -48,6 +81,20 @@ class Segment:
 class ItineraryResult:
     """An evaluated itinerary with pricing and schedule details."""
 
+    __slots__ = (
+        "include_shanghai",
+        "departure_window",
+        "order",
+        "nights_per_city",
+        "segments",
+        "total_price",
+        "total_duration_minutes",
+        "start_date",
+        "end_date",
+        "hk_arrival",
+        "hk_depart",
+    )
+
     include_shanghai: bool
     departure_window: str  # "early" | "mid" | "late"
     order: List[str]  # Asia city order (e.g., ["TYO", "HKG", "TPE"])
@@ -137,10 +184,8 @@ def write_csv_template(path: str) -> None:
     ]
 
     with open(path, "w", newline="", encoding="utf-8") as f:
-        writer = csv.DictWriter(f, fieldnames=CSV_FIELDS)
-        writer.writeheader()
-        for row in sample_rows:
-            writer.writerow(row)
+        rows = [[row[name] for name in CSV_FIELDS] for row in sample_rows]
+        csv.writer(f).writerows([CSV_FIELDS] + rows)
 
 
 # ==============================
@@ -148,28 +193,101 @@ def write_csv_template(path: str) -> None:
 # ==============================
 
 
+# How far forward a lookup may slip when nothing is found within flex_days
+DEFAULT_FALLBACK_DAYS = 7
+
+
 class FlightStore:
     """Stores flight options and provides efficient lookup with date flexibility.
 
-    The store uses a dict keyed by (origin_city, destination_city, date) mapping to the
+    The store uses a dict keyed by (origin_id, destination_id, date ordinal) mapping to the
     cheapest nonstop flight on that date. If multiple rows exist for a given key, the
     cheapest is kept.
+
+    Only fares dated within horizon (inclusive; defaults to trip_horizon()) are laid out
+    in the dense grids. Lookups reaching past it probe the dict instead, so every fare
+    stays visible.
     """
 
-    def __init__(self, flights: Iterable[FlightOption]):
-        self._by_key: Dict[Tuple[str, str, date], FlightOption] = {}
-        self._route_prices: Dict[Tuple[str, str], List[float]] = defaultdict(list)
+    def __init__(self, flights: Iterable[FlightOption], horizon: Optional[Tuple[date, date]] = None):
+        # Hot-path structures are keyed by small integer city ids (see CITY_IDS); codes
+        # outside the known set get fresh ids as they appear.
+        self._city_ids: Dict[str, int] = dict(CITY_IDS)
+        self._city_names: List[str] = list(ID_CITIES)
+        self._by_key: Dict[Tuple[int, int, int], FlightOption] = {}
         for f in flights:
             if f.stops != 0:
                 # Enforce nonstops-only policy
                 continue
-            key = (f.origin_city.upper(), f.destination_city.upper(), f.date)
+            origin = f.origin_city.upper()
+            dest = f.destination_city.upper()
+            key = (self._intern_city(origin), self._intern_city(dest), f.date.toordinal())
             existing = self._by_key.get(key)
             if existing is None or f.price < existing.price or (
                 f.price == existing.price and f.duration_minutes < existing.duration_minutes
             ):
                 self._by_key[key] = f
-            self._route_prices[(key[0], key[1])].append(f.price)
+
+        # Dense per-route grids indexed by (date ordinal - base ordinal): fares (inf when
+        # missing) and durations. A flex lookup becomes a min over a short slice.
+        # Routes are addressed as [origin_id][dest_id]; routes without data hold None.
+        # Grids only cover the search horizon, so a stray far-off date cannot inflate them;
+        # routes with fares outside it are listed in _off_grid_routes.
+        first_d, last_d = horizon if horizon is not None else trip_horizon()
+        first_ord, last_ord = first_d.toordinal(), last_d.toordinal()
+        self._horizon_ords = (first_ord, last_ord)
+        self._off_grid_routes: Set[Tuple[int, int]] = set()
+        ords = [d_ord for (_, _, d_ord) in self._by_key if first_ord <= d_ord <= last_ord]
+        self._base_ord = min(ords) if ords else 0
+        span = (max(ords) - self._base_ord + 1) if ords else 0
+        n_ids = len(self._city_names)
+        self._price_grid: List[List[Optional[List[float]]]] = [[None] * n_ids for _ in range(n_ids)]
+        self._duration_grid: List[List[Optional[List[int]]]] = [[None] * n_ids for _ in range(n_ids)]
+        # Kept (cheapest per date) fares per route; rows that lost to a cheaper fare on the
+        # same date do not count toward the route's minimum or median.
+        route_prices: Dict[Tuple[str, str], List[float]] = defaultdict(list)
+        for (o_id, d_id, d_ord), f in self._by_key.items():
+            route_prices[(self._city_names[o_id], self._city_names[d_id])].append(f.price)
+            if not first_ord <= d_ord <= last_ord:
+                self._off_grid_routes.add((o_id, d_id))
+                continue
+            prices = self._price_grid[o_id][d_id]
+            if prices is None:
+                prices = self._price_grid[o_id][d_id] = [float("inf")] * span
+                self._duration_grid[o_id][d_id] = [0] * span
+            idx = d_ord - self._base_ord
+            prices[idx] = f.price
+            self._duration_grid[o_id][d_id][idx] = f.duration_minutes
+
+        # Cheapest known fare per route, used as an admissible lower bound when pruning
+        self._min_price: Dict[Tuple[str, str], float] = {
+            route: min(prices) for route, prices in route_prices.items()
+        }
+        # Median fare per route, the default price for dates without data
+        self._route_median: Dict[Tuple[str, str], float] = {
+            route: round(float(statistics.median(prices)), 2) for route, prices in route_prices.items()
+        }
+
+    def _intern_city(self, code: str) -> int:
+        city_id = self._city_ids.get(code)
+        if city_id is None:
+            city_id = len(self._city_names)
+            self._city_ids[code] = city_id
+            self._city_names.append(code)
+        return city_id
+
+    def city_id(self, code: str) -> Optional[int]:
+        """Integer id for a city code, or None if the store has never seen it."""
+
+        return self._city_ids.get(code.upper())
+
+    def min_price(self, origin_city: str, destination_city: str) -> float:
+        """Lower bound on any fare the store can return for a route.
+
+        Routes without data fall back to synthesized defaults, so their bound is 0.
+        """
+
+        return self._min_price.get((origin_city.upper(), destination_city.upper()), 0.0)
 
     def get_best_on_date_with_flex(
         self,
@@ -177,7 +295,7 @@ class FlightStore:
         destination_city: str,
         preferred_date: date,
         flex_days: int = 1,
-        fallback_days: int = 7,
+        fallback_days: int = DEFAULT_FALLBACK_DAYS,
         allow_default: bool = True,
     ):
         """Return (FlightOption, actual_date) with layered fallbacks.
@@ -185,35 +303,116 @@ class FlightStore:
         1) Search within ±flex_days
         2) If none, search within ±fallback_days
         3) If none and allow_default, synthesize a default-priced flight on preferred_date
+
+        Flights earlier than preferred_date are never chosen (monotonic schedule), so only
+        the forward half of each window is considered.
+        """
+
+        best = self.get_best_on_ordinal_with_flex(
+            origin_city, destination_city, preferred_date.toordinal(), flex_days, fallback_days, allow_default
+        )
+        if best is None:
+            return None
+        # The chosen flight's date is the travel date (synthesized defaults use preferred_date)
+        return (best[0], best[0].date)
+
+    def get_best_on_ordinal_with_flex(
+        self,
+        origin_city: str,
+        destination_city: str,
+        preferred_ord: int,
+        flex_days: int = 1,
+        fallback_days: int = DEFAULT_FALLBACK_DAYS,
+        allow_default: bool = True,
+    ) -> Optional[Tuple[FlightOption, int]]:
+        """Same as get_best_on_date_with_flex, with dates as ordinals: (FlightOption, actual_ord)."""
+
+        o_id = self.city_id(origin_city)
+        d_id = self.city_id(destination_city)
+        if o_id is None or d_id is None:
+            # Unknown city: there are no fares, only the synthesized default
+            if not allow_default:
+                return None
+            default_flight = self._synthesize_default_flight(
+                origin_city.upper(), destination_city.upper(), date.fromordinal(preferred_ord)
+            )
+            return (default_flight, preferred_ord)
+        return self.get_best_by_ids(o_id, d_id, preferred_ord, flex_days, fallback_days, allow_default)
+
+    def get_best_by_ids(
+        self,
+        o_id: int,
+        d_id: int,
+        preferred_ord: int,
+        flex_days: int = 1,
+        fallback_days: int = DEFAULT_FALLBACK_DAYS,
+        allow_default: bool = True,
+    ) -> Optional[Tuple[FlightOption, int]]:
+        """Same as get_best_on_ordinal_with_flex, with cities given as ids from city_id()."""
+
+        hit = self.best_idx_window(o_id, d_id, preferred_ord, flex_days)
+        if hit is None and fallback_days and fallback_days > flex_days:
+            # Nothing within flex_days, so only the days beyond it can hold a fare
+            hit = self.best_idx_window(o_id, d_id, preferred_ord + flex_days + 1, fallback_days - flex_days - 1)
+        if hit is None:
+            if allow_default:
+                default_flight = self._synthesize_default_flight(
+                    self._city_names[o_id], self._city_names[d_id], date.fromordinal(preferred_ord)
+                )
+                return (default_flight, preferred_ord)
+            return None
+        return (self._by_key[(o_id, d_id, hit[0])], hit[0])
+
+    def best_idx_window(
+        self, o_id: int, d_id: int, d_ord: int, flex: int
+    ) -> Optional[Tuple[int, float]]:
+        """Return (date_ordinal, price) of the best fare in [d_ord, d_ord + flex], or None.
+
+        Best means cheapest, then shortest duration, then earliest date.
         """
 
-        origin = origin_city.upper()
-        dest = destination_city.upper()
-        candidates: List[Tuple[FlightOption, date]] = []
-        for delta in range(-flex_days, flex_days + 1):
-            d = preferred_date + timedelta(days=delta)
-            # Do not allow flights earlier than preferred_date (monotonic schedule)
-            if d < preferred_date:
+        hit = self._best_in_grid(o_id, d_id, d_ord, flex)
+        if (o_id, d_id) not in self._off_grid_routes:
+            return hit
+        first_ord, last_ord = self._horizon_ords
+        if first_ord <= d_ord and d_ord + flex <= last_ord:
+            return hit
+        # The window leaves the grid: probe the dict for the days outside it
+        best = None
+        if hit is not None:
+            best = (hit[1], self._duration_grid[o_id][d_id][hit[0] - self._base_ord], hit[0])
+        for day_ord in range(d_ord, d_ord + flex + 1):
+            if first_ord <= day_ord <= last_ord:
                 continue
-            f = self._by_key.get((origin, dest, d))
-            if f is not None:
-                candidates.append((f, d))
-        if not candidates:
-            if fallback_days and fallback_days > flex_days:
-                for delta in range(-fallback_days, fallback_days + 1):
-                    d = preferred_date + timedelta(days=delta)
-                    if d < preferred_date:
-                        continue
-                    f = self._by_key.get((origin, dest, d))
-                    if f is not None:
-                        candidates.append((f, d))
-        if not candidates and allow_default:
-            default_flight = self._synthesize_default_flight(origin, dest, preferred_date)
-            return (default_flight, preferred_date)
-        if not candidates:
+            f = self._by_key.get((o_id, d_id, day_ord))
+            if f is not None and (best is None or (f.price, f.duration_minutes, day_ord) < best):
+                best = (f.price, f.duration_minutes, day_ord)
+        if best is None:
             return None
-        candidates.sort(key=lambda x: (x[0].price, x[0].duration_minutes, x[1]))
-        return candidates[0]
+        return (best[2], best[0])
+
+    def _best_in_grid(
+        self, o_id: int, d_id: int, d_ord: int, flex: int
+    ) -> Optional[Tuple[int, float]]:
+        prices = self._price_grid[o_id][d_id]
+        if prices is None:
+            return None
+        lo = max(d_ord - self._base_ord, 0)
+        hi = min(d_ord + flex - self._base_ord + 1, len(prices))
+        if lo >= hi:
+            return None
+        window = prices[lo:hi]
+        best_price = min(window)
+        if best_price == float("inf"):
+            return None
+        # Earliest cheapest day found in C; only later days can still win on duration
+        best_idx = prices.index(best_price, lo, hi)
+        if best_idx + 1 < hi and best_price in window[best_idx + 1 - lo :]:
+            durations = self._duration_grid[o_id][d_id]
+            for i in range(best_idx + 1, hi):
+                if prices[i] == best_price and durations[i] < durations[best_idx]:
+                    best_idx = i
+        return (best_idx + self._base_ord, best_price)
 
     # ---------- Defaults helpers ----------
 
@@ -232,12 +431,9 @@ class FlightStore:
 
     def _compute_default_price(self, origin: str, dest: str, d: date) -> float:
         # If we have historical prices for this route, use median
-        route_prices = self._route_prices.get((origin, dest), [])
-        if route_prices:
-            try:
-                return round(float(statistics.median(route_prices)), 2)
-            except statistics.StatisticsError:
-                pass
+        median = self._route_median.get((origin, dest))
+        if median is not None:
+            return median
 
         ASIA_SET = {TOKYO, HONG_KONG, TAIWAN, SHANGHAI}
 
@@ -277,6 +473,54 @@ class FlightStore:
         return 1000.0
 
 
+class LegCostCache:
+    """Memo of flex lookups, shareable across searches over the same FlightStore.
+
+    Keys are (origin_id, dest_id, preferred_ord, flex_days) and values are the result of
+    FlightStore.get_best_by_ids flattened to (FlightOption, actual_ord, price,
+    duration_minutes), or None, so the search kernel adds fares without attribute access.
+    The search repeats identical leg queries across orders, nights and Shanghai
+    variants, so one cache per CLI run serves every build_itineraries call.
+    """
+
+    def __init__(self, store: FlightStore):
+        self.store = store
+        self._entries: Dict[Tuple[int, int, int, int], Optional[Tuple[FlightOption, int, float, int]]] = {}
+
+    def get(
+        self, o_id: int, d_id: int, preferred_ord: int, flex_days: int
+    ) -> Optional[Tuple[FlightOption, int, float, int]]:
+        key = (o_id, d_id, preferred_ord, flex_days)
+        try:
+            return self._entries[key]
+        except KeyError:
+            pass
+        result = self._lookup(o_id, d_id, preferred_ord, flex_days)
+        self._entries[key] = result
+        return result
+
+    def _lookup(
+        self, o_id: int, d_id: int, preferred_ord: int, flex_days: int
+    ) -> Optional[Tuple[FlightOption, int, float, int]]:
+        best = self.store.get_best_by_ids(o_id, d_id, preferred_ord, flex_days)
+        if best is None:
+            return None
+        flight, used = best
+        return (flight, used, flight.price, flight.duration_minutes)
+
+    def warm(self, o_id: int, dest_ids: Iterable[int], ords: Iterable[int], flex_days: int) -> None:
+        """Pre-populate lookups for every (destination, ordinal) pair in one pass."""
+
+        lookup = self._lookup
+        entries = self._entries
+        ords = list(ords)
+        for d_id in dest_ids:
+            for d_ord in ords:
+                key = (o_id, d_id, d_ord, flex_days)
+                if key not in entries:
+                    entries[key] = lookup(o_id, d_id, d_ord, flex_days)
+
+
 def parse_csv(path: str) -> List[FlightOption]:
     """Parse the flight CSV according to the expected schema.
 
@@ -285,61 +529,97 @@ def parse_csv(path: str) -> List[FlightOption]:
     """
 
     flights: List[FlightOption] = []
+    # Read the whole file in one call and parse from memory rather than line by line
     with open(path, newline="", encoding="utf-8") as f:
-        reader = csv.DictReader(f)
-        for _, row in enumerate(reader, start=2):  # start=2 accounts for header line being 1
-            try:
-                origin_city = row.get("origin_city", "").strip().upper()
-                destination_city = row.get("destination_city", "").strip().upper()
-                if not origin_city or not destination_city:
-                    continue
+        data = f.read()
+    reader = csv.reader(io.StringIO(data, newline=""))
+    header = next(reader, None)
+    if header is None:
+        return flights
+
+    # Resolve column positions once. Columns absent from the header read as "" (index -1
+    # into a padded row); rows too short to hold every present column are skipped.
+    col = {name: i for i, name in enumerate(header)}
+    pad = any(name not in col for name in CSV_FIELDS)
+    min_len = max((col[name] for name in CSV_FIELDS if name in col), default=-1) + 1
+    (
+        origin_i,
+        dest_i,
+        date_i,
+        price_i,
+        stops_i,
+        dur_i,
+        airline_i,
+        link_i,
+    ) = (col.get(name, -1) for name in CSV_FIELDS)
+    # Many rows share a travel date; parse each distinct date string once
+    parsed_dates: Dict[str, date] = {}
+    # Raw city cell -> normalized code, interned so all rows share one string per city
+    city_codes: Dict[str, str] = {}
+
+    for row in reader:
+        if len(row) < min_len:
+            continue
+        if pad:
+            row.append("")
+        try:
+            origin_city = city_codes.get(row[origin_i])
+            if origin_city is None:
+                origin_city = city_codes[row[origin_i]] = sys.intern(row[origin_i].strip().upper())
+            destination_city = city_codes.get(row[dest_i])
+            if destination_city is None:
+                destination_city = city_codes[row[dest_i]] = sys.intern(row[dest_i].strip().upper())
+            if not origin_city or not destination_city:
+                continue
 
-                # Date
-                date_str = row.get("date", "").strip()
-                if not date_str:
-                    continue
-                d = datetime.strptime(date_str, "%Y-%m-%d").date()
+            # Date
+            date_str = row[date_i].strip()
+            if not date_str:
+                continue
+            d = parsed_dates.get(date_str)
+            if d is None:
+                d = parsed_dates[date_str] = datetime.strptime(date_str, "%Y-%m-%d").date()
 
-                # Price
-                price_str = row.get("price", "").strip()
-                if not price_str:
-                    continue
-                price = float(price_str)
+            # Price
+            price_str = row[price_i].strip()
+            if not price_str:
+                continue
+            price = float(price_str)
 
-                # Stops
-                stops_str = row.get("stops", "").strip()
-                if stops_str == "":
-                    # Unknown -> exclude to satisfy nonstops-only requirement
-                    continue
-                stops = int(stops_str)
-                if stops != 0:
-                    # Nonstops only
-                    continue
+            # Stops
+            stops_str = row[stops_i].strip()
+            if stops_str == "":
+                # Unknown -> exclude to satisfy nonstops-only requirement
+                continue
+            stops = int(stops_str)
+            if stops != 0:
+                # Nonstops only
+                continue
 
-                # Optional fields
-                duration_minutes = 0
-                dur_str = row.get("duration_minutes", "").strip()
-                if dur_str:
-                    duration_minutes = int(dur_str)
-
-                airline = row.get("airline", "").strip()
-                booking_link = row.get("booking_link", "").strip()
-
-                flights.append(
-                    FlightOption(
-                        origin_city=origin_city,
-                        destination_city=destination_city,
-                        date=d,
-                        price=price,
-                        stops=stops,
-                        duration_minutes=duration_minutes,
-                        airline=airline,
-                        booking_link=booking_link,
-                    )
+            # Optional fields
+            duration_minutes = 0
+            dur_str = row[dur_i].strip()
+            if dur_str:
+                duration_minutes = int(dur_str)
+
+            airline = row[airline_i].strip()
+            booking_link = row[link_i].strip()
+
+            flights.append(
+                FlightOption(
+                    origin_city=origin_city,
+                    destination_city=destination_city,
+                    date=d,
+                    price=price,
+                    stops=stops,
+                    duration_minutes=duration_minutes,
+                    airline=airline,
+                    booking_link=booking_link,
                 )
-            except Exception:
-                # Skip malformed rows silently to keep tool robust
-                continue
+            )
+        except Exception:
+            # Skip malformed rows silently to keep tool robust
+            continue
     return flights
 
 
@@ -354,14 +634,19 @@ HONG_KONG = "HKG"
 TAIWAN = "TPE"
 SHANGHAI = "SHA"
 
+# Small integer ids for the known city codes; the search and FlightStore key on these
+ID_CITIES = [NYC, TOKYO, HONG_KONG, TAIWAN, SHANGHAI]
+CITY_IDS = {city: i for i, city in enumerate(ID_CITIES)}
+
+
+# Slack when comparing float price sums against the k-th best (rounded to cents)
+_PRICE_BOUND_TOLERANCE = 0.005
 
-def daterange(start: date, end: date) -> Iterable[date]:
-    """Yield dates from start to end inclusive."""
 
-    cur = start
-    while cur <= end:
-        yield cur
-        cur += timedelta(days=1)
+def ordinal_daterange(start: date, end: date) -> range:
+    """Date ordinals from start to end inclusive, as a reusable range (O(1) len/membership)."""
+
+    return range(start.toordinal(), end.toordinal() + 1)
 
 
 def departure_windows_dec_2025() -> Dict[str, Tuple[date, date]]:
@@ -379,6 +664,23 @@ def departure_windows_dec_2025() -> Dict[str, Tuple[date, date]]:
     }
 
 
+def trip_horizon(
+    windows: Optional[Dict[str, Tuple[date, date]]] = None, max_total_days: int = 25
+) -> Tuple[date, date]:
+    """Dates a search over windows is expected to use fares on.
+
+    Runs from the first departure through the last possible return, plus
+    DEFAULT_FALLBACK_DAYS of forward slip. FlightStore lays out its dense grids over this
+    range; lookups outside it still work, only more slowly.
+    """
+
+    if windows is None:
+        windows = departure_windows_dec_2025()
+    first_d = min(start_d for start_d, _ in windows.values())
+    last_d = max(end_d for _, end_d in windows.values())
+    return first_d, date.fromordinal(last_d.toordinal() + max_total_days + DEFAULT_FALLBACK_DAYS)
+
+
 def default_nights(include_shanghai: bool) -> Dict[str, int]:
     base = {
         TOKYO: 5,
@@ -396,156 +698,465 @@ def nights_choices(nights: Dict[str, int]) -> Dict[str, Tuple[int, int]]:
     return {city: (max(4, n - 1), max(4, n + 1)) for city, n in nights.items()}
 
 
-def enforce_hk_anchor(hk_arrival: date, hk_depart: date) -> bool:
-    """Must be in HK from 2025-12-28 through 2026-01-01 inclusive.
-
-    That implies arrival on/before 12/28 and departure on/after 01/02.
-    """
-
-    must_arrive_by = date(2025, 12, 28)
-    earliest_depart = date(2026, 1, 2)
-    return hk_arrival <= must_arrive_by and hk_depart >= earliest_depart
+# HK anchor: must be in HK from 2025-12-28 through 2026-01-01 inclusive, i.e. arrive
+# on/before 12/28 and depart on/after 01/02. The search compares date ordinals.
+HK_MUST_ARRIVE_BY = date(2025, 12, 28)
+HK_EARLIEST_DEPART = date(2026, 1, 2)
+_HK_MUST_ARRIVE_BY_ORD = HK_MUST_ARRIVE_BY.toordinal()
+_HK_EARLIEST_DEPART_ORD = HK_EARLIEST_DEPART.toordinal()
 
 
 def build_itineraries(
     store: FlightStore,
-    include_shanghai: bool,
+    include_shanghai: Optional[bool],
     windows: Dict[str, Tuple[date, date]],
     top_k: int = 10,
     flex_days: int = 1,
     min_total_days: int = 17,
     max_total_days: int = 25,
+    leg_cache: Optional[LegCostCache] = None,
 ) -> List[ItineraryResult]:
     """Search itineraries under constraints, returning top_k by price.
 
+    include_shanghai=None searches both city sets (with and without Shanghai) in one sweep
+    over a shared leg cache and returns the global top_k across them.
+
     Approach:
     - Generate permutations of city orders for target set (with/without Shanghai).
     - For each departure date in early/mid/late windows, try all combinations of nights (±1).
     - For each option, pick flights on preferred dates with ±flex_days to minimize price.
     - Assume flights consume 1 day (arrival = depart + 1 day). Rough estimate is acceptable.
     - Enforce HK anchor and total trip length 17–25 days.
+    - Branch-and-bound: once top_k itineraries are known, abandon a partial itinerary as
+      soon as its price plus the cheapest possible remaining legs exceeds the k-th best.
+    - Leg lookups go through leg_cache; pass one LegCostCache to share lookups between
+      searches (e.g. with and without Shanghai).
+    """
+
+    if leg_cache is None:
+        leg_cache = LegCostCache(store)
+    departures = _departures(windows)
+    variants = [True, False] if include_shanghai is None else [include_shanghai]
+    results: List[ItineraryResult] = []
+    for with_shanghai in variants:
+        groups = _search(
+            leg_cache,
+            with_shanghai,
+            departures,
+            top_k,
+            flex_days,
+            min_total_days,
+            max_total_days,
+            per_window=False,
+        )
+        results += groups.get(None, [])
+    if len(variants) > 1:
+        # Keep the global top_k across both city sets (stable, like sorted()[:top_k])
+        results = heapq.nsmallest(top_k, results, key=ItineraryResult.score_tuple)
+    return results
+
+
+def build_itineraries_grouped(
+    store: FlightStore,
+    windows: Dict[str, Tuple[date, date]],
+    top_k: int = 1,
+    flex_days: int = 1,
+    min_total_days: int = 17,
+    max_total_days: int = 25,
+    leg_cache: Optional[LegCostCache] = None,
+) -> Dict[Tuple[str, bool], List[ItineraryResult]]:
+    """Top_k itineraries for every (window, include_shanghai) cell in one search per city set.
+
+    Equivalent to calling build_itineraries once per window and Shanghai setting, but the
+    order plans and leg lookups are built once per city set and each window keeps its own
+    top_k heap (and pruning bound) inside a single enumeration.
+    """
+
+    if leg_cache is None:
+        leg_cache = LegCostCache(store)
+    departures = _departures(windows)
+    cells: Dict[Tuple[str, bool], List[ItineraryResult]] = {}
+    for include_shanghai in (True, False):
+        groups = _search(
+            leg_cache,
+            include_shanghai,
+            departures,
+            top_k,
+            flex_days,
+            min_total_days,
+            max_total_days,
+            per_window=True,
+        )
+        for window_name in windows:
+            cells[(window_name, include_shanghai)] = groups.get(window_name, [])
+    return cells
+
+
+def _departures(windows: Dict[str, Tuple[date, date]]) -> List[Tuple[str, int]]:
+    """Flatten windows into (window_name, departure ordinal) pairs in search order."""
+
+    return [
+        (window_name, depart_ord)
+        for window_name, (start_d, end_d) in windows.items()
+        for depart_ord in ordinal_daterange(start_d, end_d)
+    ]
+
+
+def _search(
+    leg_cache: LegCostCache,
+    include_shanghai: bool,
+    departures: List[Tuple[str, int]],
+    top_k: int,
+    flex_days: int,
+    min_total_days: int,
+    max_total_days: int,
+    per_window: bool,
+) -> Dict[Optional[str], List[ItineraryResult]]:
+    """Run the enumeration kernel and materialize its survivors.
+
+    Results are grouped by window name when per_window is set, else under the key None.
     """
 
     cities = [TOKYO, HONG_KONG, TAIWAN] + ([SHANGHAI] if include_shanghai else [])
     base_n = default_nights(include_shanghai)
     ranges = nights_choices(base_n)
 
-    results: List[ItineraryResult] = []
-    for window_name, (start_d, end_d) in windows.items():
-        for depart_d in daterange(start_d, end_d):
-            for order in permutations(cities):
-                # Iterate all combinations of nights per city within [min,max]
-                bounds = [ranges[c] for c in order]
-                for nights_tuple in product(*[range(lo, hi + 1) for lo, hi in bounds]):
-                    nights_map = {city: nights_tuple[i] for i, city in enumerate(order)}
-
-                    # Build schedule
-                    segments: List[Segment] = []
-                    total_price = 0.0
-                    total_duration = 0
-
-                    # NYC -> first city
-                    current_depart_date = depart_d
-                    first_city = order[0]
-                    best = store.get_best_on_date_with_flex(
-                        NYC, first_city, current_depart_date, flex_days
-                    )
-                    if best is None:
+    # Outbound NYC legs are known exactly (every departure date x first city)
+    leg_cache.warm(
+        CITY_IDS[NYC], [CITY_IDS[c] for c in cities], sorted({d_ord for _, d_ord in departures}), flex_days
+    )
+
+    groups = _enumerate_candidates(
+        leg_cache, cities, ranges, departures, top_k, flex_days, min_total_days, max_total_days, per_window
+    )
+
+    # Only the top_k survivors are materialized as ItineraryResult objects
+    return {
+        group: [
+            ItineraryResult(
+                include_shanghai=include_shanghai,
+                departure_window=window_name,
+                order=list(order),
+                nights_per_city=nights_map,
+                segments=_segments_from_legs(order, legs),
+                total_price=price,
+                total_duration_minutes=total_duration,
+                start_date=date.fromordinal(depart_ord),
+                end_date=date.fromordinal(arrive_back),
+                hk_arrival=date.fromordinal(hk_arrival),
+                hk_depart=date.fromordinal(hk_depart),
+            )
+            for (
+                price,
+                total_duration,
+                depart_ord,
+                window_name,
+                order,
+                nights_map,
+                legs,
+                arrive_back,
+                hk_arrival,
+                hk_depart,
+            ) in rows
+        ]
+        for group, rows in groups.items()
+    }
+
+
+def _segments_from_legs(
+    order: Tuple[str, ...], legs: Tuple[Tuple[FlightOption, int, float, int], ...]
+) -> List[Segment]:
+    """Build Segments for NYC -> order... -> NYC from LegCostCache entries."""
+
+    stops = (NYC, *order, NYC)
+    return [
+        Segment(stops[i], stops[i + 1], leg[0].date, date.fromordinal(leg[1] + 1), leg[0])
+        for i, leg in enumerate(legs)
+    ]
+
+
+def _enumerate_candidates(
+    leg_cache: LegCostCache,
+    cities: List[str],
+    ranges: Dict[str, Tuple[int, int]],
+    departures: List[Tuple[str, int]],
+    top_k: int,
+    flex_days: int,
+    min_total_days: int,
+    max_total_days: int,
+    per_window: bool = False,
+) -> Dict[Optional[str], List[tuple]]:
+    """Enumeration kernel behind build_itineraries.
+
+    Walks every (departure, city order, nights combination) and returns the top_k feasible
+    candidates per group (the window name when per_window is set, else None) as plain
+    tuples, sorted by (price, duration, start date) with enumeration order breaking ties:
+    (price, total_duration, depart_ord, window_name, order, nights_map, legs,
+    arrive_back_ord, hk_arrival_ord, hk_depart_ord), where legs holds the LegCostCache
+    entry (FlightOption, depart_ord, price, duration_minutes) of each flight.
+
+    Schedule arithmetic is done on date ordinals; no date or Segment objects are built.
+    """
+
+    store = leg_cache.store
+    lookup = leg_cache.get
+    # Module globals and helpers used per candidate, bound as locals for the hot loops
+    tol = _PRICE_BOUND_TOLERANCE
+    arrive_by = _HK_MUST_ARRIVE_BY_ORD
+    depart_from = _HK_EARLIEST_DEPART_ORD
+    heappush = heapq.heappush
+    heappushpop = heapq.heappushpop
+    max_slip = max(flex_days, DEFAULT_FALLBACK_DAYS)
+    if top_k <= 0 or not departures:
+        return {}
+    # Per group, a bounded heap of the top_k candidates keyed by the negated
+    # (score, sequence) so the root is the current worst survivor; its price is the
+    # group's branch-and-bound threshold.
+    heaps: Dict[Optional[str], List[Tuple[Tuple[float, int, int, int], tuple]]] = {}
+    kth_prices: Dict[Optional[str], float] = {}
+    seq = 0
+    # Per-order data is independent of the departure date, so build it once. Orders that
+    # cannot meet the HK anchor from any departure in this batch are dropped up front.
+    first_depart = min(d_ord for _, d_ord in departures)
+    last_depart = max(d_ord for _, d_ord in departures)
+    plans = []
+    # Nights combinations for the cities between the first and the last, keyed by those
+    # cities in order; product() keeps the later city varying fastest.
+    middle_grids: Dict[Tuple[str, ...], List[Tuple[int, ...]]] = {}
+    for order in permutations(cities):
+        # remaining_lb[j] = cheapest possible cost of legs j..end (leg 0 is NYC -> order[0])
+        stops = [NYC, *order, NYC]
+        remaining_lb = [0.0] * (len(stops) + 1)
+        for j in range(len(stops) - 2, -1, -1):
+            remaining_lb[j] = remaining_lb[j + 1] + store.min_price(stops[j], stops[j + 1])
+
+        nights_lo = [ranges[c][0] for c in order]
+        nights_hi = [ranges[c][1] for c in order]
+
+        # HK anchor bounds relative to the arrival of the first leg: each later leg departs
+        # between 0 and max_slip days after its preferred date and lands one day later.
+        hk_pos = order.index(HONG_KONG)
+        hk_arrival_lo = sum(nights_lo[j] + 1 for j in range(hk_pos))
+        hk_depart_hi = sum(nights_hi[j] + 1 + max_slip for j in range(hk_pos)) + nights_hi[hk_pos] + max_slip
+        if first_depart + 1 + hk_arrival_lo > arrive_by:
+            continue
+        if last_depart + max_slip + 1 + hk_depart_hi < depart_from:
+            continue
+        # The same bounds relative to the arrival of the second leg, for HK after the first
+        # city; checked once the first stay is fixed.
+        hk_arrival_lo1 = sum(nights_lo[j] + 1 for j in range(1, hk_pos))
+        hk_depart_hi1 = sum(nights_hi[j] + 1 + max_slip for j in range(1, hk_pos)) + nights_hi[hk_pos] + max_slip
+        order_ids = tuple(CITY_IDS[c] for c in order)
+        first_nights = range(nights_lo[0], nights_hi[0] + 1)
+        last_nights = range(nights_lo[-1], nights_hi[-1] + 1)
+        middle_grid = middle_grids.get(order[1:-1])
+        if middle_grid is None:
+            middle_grid = middle_grids[order[1:-1]] = list(
+                product(*(range(lo, hi + 1) for lo, hi in zip(nights_lo[1:-1], nights_hi[1:-1])))
+            )
+        plans.append(
+            (
+                order,
+                order_ids,
+                remaining_lb,
+                first_nights,
+                middle_grid,
+                last_nights,
+                hk_arrival_lo,
+                hk_depart_hi,
+                hk_arrival_lo1,
+                hk_depart_hi1,
+            )
+        )
+
+    n_cities = len(cities)
+    nyc_id = CITY_IDS[NYC]
+    hk_id = CITY_IDS[HONG_KONG]
+    for window_name, depart_ord in departures:
+        group = window_name if per_window else None
+        heap = heaps.setdefault(group, [])
+        kth_price = kth_prices.setdefault(group, float("inf"))
+        for (
+            order,
+            order_ids,
+            remaining_lb,
+            first_nights,
+            middle_grid,
+            last_nights,
+            hk_arrival_lo,
+            hk_depart_hi,
+            hk_arrival_lo1,
+            hk_depart_hi1,
+        ) in plans:
+            # Cheapest conceivable itinerary for this order already loses to the k-th best
+            if remaining_lb[0] - kth_price > tol:
+                continue
+            # NYC -> first city only depends on the departure date and the first city
+            first_id = order_ids[0]
+            last_id = order_ids[-1]
+            best = lookup(nyc_id, first_id, depart_ord, flex_days)
+            if best is None:
+                continue
+            _, used0, price0, duration0 = best
+            arrive0 = used0 + 1
+            if price0 + remaining_lb[1] - kth_price > tol:
+                continue
+
+            # HK anchor pre-filter over every nights combination for this departure
+            if arrive0 + hk_arrival_lo > arrive_by:
+                continue
+            if arrive0 + hk_depart_hi < depart_from:
+                continue
+
+            # Cache entry per leg, overwritten per combination; snapshotted only for heap
+            # survivors, which become Segments in build_itineraries.
+            legs: List[Tuple[FlightOption, int, float, int]] = [best] * (n_cities + 1)
+            nights_combo = [0] * n_cities
+            for n0 in first_nights:
+                # Prefix shared by every combination with this first-city stay: the second
+                # leg only depends on arrive0 and nights in the first city.
+                nights_combo[0] = n0
+                prefix_depart = arrive0 + n0
+                best_leg = lookup(first_id, order_ids[1], prefix_depart, flex_days)
+                if best_leg is None:
+                    continue
+                _, used1, price1, duration1 = best_leg
+                arrive1 = used1 + 1
+                legs[1] = best_leg
+                prefix_price = price0 + price1
+                prefix_duration = duration0 + duration1
+                if prefix_price + remaining_lb[2] - kth_price > tol:
+                    continue
+                prefix_hk_arrival: Optional[int] = None
+                if first_id == hk_id:
+                    prefix_hk_arrival = arrive0
+                elif order_ids[1] == hk_id:
+                    prefix_hk_arrival = arrive1
+                prefix_hk_depart: Optional[int] = used1 if first_id == hk_id else None
+                # HK anchor pre-filter over every nights combination sharing this prefix
+                if prefix_hk_depart is not None:
+                    if prefix_hk_depart < depart_from:
                         continue
-                    flight0, used_d0 = best
-                    arrive = used_d0 + timedelta(days=1)
-                    segments.append(
-                        Segment(NYC, first_city, used_d0, arrive, flight0)
-                    )
-                    total_price += flight0.price
-                    total_duration += flight0.duration_minutes
+                elif arrive1 + hk_arrival_lo1 > arrive_by or arrive1 + hk_depart_hi1 < depart_from:
+                    continue
 
-                    # Stay in first city
-                    current_depart_date = arrive + timedelta(days=nights_map[first_city])
+                for middle in middle_grid:
+                    nights_combo[1:-1] = middle
 
-                    hk_arrival: Optional[date] = arrive if first_city == HONG_KONG else None
-                    hk_depart: Optional[date] = None
+                    # Legs between Asian cities, built from the shared prefix
+                    arrive = arrive1
+                    total_price = prefix_price
+                    total_duration = prefix_duration
+                    current_depart = arrive + nights_combo[1]
+                    hk_arrival = prefix_hk_arrival
+                    hk_depart = prefix_hk_depart
 
                     feasible = True
-                    for i in range(len(order) - 1):
-                        origin = order[i]
-                        dest = order[i + 1]
-                        best_leg = store.get_best_on_date_with_flex(
-                            origin, dest, current_depart_date, flex_days
-                        )
+                    for i in range(1, n_cities - 1):
+                        origin = order_ids[i]
+                        dest = order_ids[i + 1]
+                        best_leg = lookup(origin, dest, current_depart, flex_days)
                         if best_leg is None:
                             feasible = False
                             break
-                        flight, used_d = best_leg
-                        arrive = used_d + timedelta(days=1)
-                        segments.append(Segment(origin, dest, used_d, arrive, flight))
-                        total_price += flight.price
-                        total_duration += flight.duration_minutes
+                        _, used, leg_price, leg_duration = best_leg
+                        arrive = used + 1
+                        legs[i + 1] = best_leg
+                        total_price += leg_price
+                        total_duration += leg_duration
+                        if total_price + remaining_lb[i + 2] - kth_price > tol:
+                            feasible = False
+                            break
 
                         # Track HK anchor window
-                        if dest == HONG_KONG and hk_arrival is None:
+                        if dest == hk_id and hk_arrival is None:
                             hk_arrival = arrive
-                        if origin == HONG_KONG and hk_depart is None:
-                            hk_depart = used_d
+                        if origin == hk_id and hk_depart is None:
+                            hk_depart = used
 
-                        # Next depart after stay in destination (monotonic progression)
-                        next_earliest = arrive + timedelta(days=nights_map[dest])
-                        if next_earliest < current_depart_date:
-                            feasible = False
-                            break
-                        current_depart_date = next_earliest
+                        if i + 1 < n_cities - 1:
+                            # Next depart after stay in destination (monotonic progression)
+                            next_earliest = arrive + nights_combo[i + 1]
+                            if next_earliest < current_depart:
+                                feasible = False
+                                break
+                            current_depart = next_earliest
 
                     if not feasible:
                         continue
 
-                    # Last city -> NYC
-                    last_city = order[-1]
-                    best_back = store.get_best_on_date_with_flex(last_city, NYC, current_depart_date, flex_days)
-                    if best_back is None:
-                        continue
-                    flight_back, used_db = best_back
-                    arrive_back = used_db + timedelta(days=1)
-                    segments.append(
-                        Segment(last_city, NYC, used_db, arrive_back, flight_back)
-                    )
-                    total_price += flight_back.price
-                    total_duration += flight_back.duration_minutes
-
-                    # If we never departed HKG (i.e., HKG is last city), set hk_depart to the NYC leg date
-                    if hk_depart is None and last_city == HONG_KONG:
-                        hk_depart = used_db
-
-                    # Validate HK anchor
-                    if hk_arrival is None or hk_depart is None:
-                        # No HK present – invalid order for requirements
-                        continue
-                    if not enforce_hk_anchor(hk_arrival, hk_depart):
-                        continue
-
-                    # Validate total trip length
-                    total_days = (arrive_back - depart_d).days + 1
-                    if total_days < min_total_days or total_days > max_total_days:
-                        continue
-
-                    results.append(
-                        ItineraryResult(
-                            include_shanghai=include_shanghai,
-                            departure_window=window_name,
-                            order=list(order),
-                            nights_per_city=nights_map,
-                            segments=segments,
-                            total_price=round(total_price, 2),
-                            total_duration_minutes=total_duration,
-                            start_date=depart_d,
-                            end_date=arrive_back,
-                            hk_arrival=hk_arrival,
-                            hk_depart=hk_depart,
+                    # Everything up to the arrival in the last city is now fixed; only the
+                    # return leg depends on the nights spent there.
+                    for n_last in last_nights:
+                        nights_combo[-1] = n_last
+                        back_depart = arrive + n_last
+                        if back_depart < current_depart:
+                            continue
+
+                        # Last city -> NYC
+                        best_back = lookup(last_id, nyc_id, back_depart, flex_days)
+                        if best_back is None:
+                            continue
+                        _, used_back, price_back, duration_back = best_back
+                        arrive_back = used_back + 1
+                        legs[n_cities] = best_back
+                        trip_price = total_price + price_back
+                        trip_duration = total_duration + duration_back
+                        if trip_price - kth_price > tol:
+                            continue
+
+                        # If we never departed HKG (i.e., HKG is last city), use the NYC leg date
+                        trip_hk_depart = hk_depart
+                        if trip_hk_depart is None and last_id == hk_id:
+                            trip_hk_depart = used_back
+
+                        # Validate HK anchor
+                        if hk_arrival is None or trip_hk_depart is None:
+                            # No HK present – invalid order for requirements
+                            continue
+                        if hk_arrival > arrive_by or trip_hk_depart < depart_from:
+                            continue
+
+                        # Validate total trip length
+                        total_days = arrive_back - depart_ord + 1
+                        if total_days < min_total_days or total_days > max_total_days:
+                            continue
+
+                        price = round(trip_price, 2)
+                        seq += 1
+                        key = (-price, -trip_duration, -depart_ord, -seq)
+                        if len(heap) == top_k and key < heap[0][0]:
+                            # Worse than every current survivor
+                            continue
+                        # The nights dict is only materialized for candidates entering the heap
+                        nights_map = {city: nights_combo[i] for i, city in enumerate(order)}
+                        entry = (
+                            key,
+                            (
+                                price,
+                                trip_duration,
+                                depart_ord,
+                                window_name,
+                                order,
+                                nights_map,
+                                tuple(legs),
+                                arrive_back,
+                                hk_arrival,
+                                trip_hk_depart,
+                            ),
                         )
-                    )
+                        if len(heap) < top_k:
+                            heappush(heap, entry)
+                        else:
+                            heappushpop(heap, entry)
+                        if len(heap) == top_k:
+                            kth_price = kth_prices[group] = -heap[0][0][0]
 
-    # Sort and return top_k
-    results.sort(key=lambda r: r.score_tuple())
-    return results[:top_k]
+    result: Dict[Optional[str], List[tuple]] = {}
+    for group, heap in heaps.items():
+        heap.sort(reverse=True)
+        result[group] = [row for _, row in heap]
+    return result
 
 
 # ==============================
@@ -594,28 +1205,19 @@ def build_summary_matrix(
     desired_order = ["early", "mid", "late"]
     row_order = [w for w in desired_order if w in windows]
 
+    cells = build_itineraries_grouped(
+        store,
+        windows={w: windows[w] for w in row_order},
+        top_k=1,
+        flex_days=flex_days,
+        min_total_days=min_total_days,
+        max_total_days=max_total_days,
+    )
+
     matrix: Dict[str, Dict[str, Optional[ItineraryResult]]] = {}
     for w in row_order:
-        win_dict = {w: windows[w]}
-        best_with = build_itineraries(
-            store,
-            include_shanghai=True,
-            windows=win_dict,
-            top_k=1,
-            flex_days=flex_days,
-            min_total_days=min_total_days,
-            max_total_days=max_total_days,
-        )
-        best_without = build_itineraries(
-            store,
-            include_shanghai=False,
-            windows=win_dict,
-            top_k=1,
-            flex_days=flex_days,
-            min_total_days=min_total_days,
-            max_total_days=max_total_days,
-        )
-
+        best_with = cells[(w, True)]
+        best_without = cells[(w, False)]
         matrix[w] = {
             "with_SHA": best_with[0] if best_with else None,
             "without_SHA": best_without[0] if best_without else None,
@@ -732,25 +1334,22 @@ def main() -> None:
         return
 
     # Default behavior: compute global top N across both include/exclude Shanghai sets
-    results: List[ItineraryResult] = []
-    if not args.exclude_shanghai:
-        results += build_itineraries(
-            store,
-            include_shanghai=True,
-            windows=windows,
-            top_k=args.top,
-        )
-    if not args.include_shanghai:
-        results += build_itineraries(
-            store,
-            include_shanghai=False,
-            windows=windows,
-            top_k=args.top,
-        )
-
-    # Keep global top N across both groups
-    results.sort(key=lambda r: r.score_tuple())
-    print_results(results[: args.top])
+    if args.include_shanghai and args.exclude_shanghai:
+        # Contradictory filters leave nothing to search
+        print_results([])
+        return
+    include_shanghai: Optional[bool] = None
+    if args.include_shanghai:
+        include_shanghai = True
+    elif args.exclude_shanghai:
+        include_shanghai = False
+    results = build_itineraries(
+        store,
+        include_shanghai=include_shanghai,
+        windows=windows,
+        top_k=args.top,
+    )
+    print_results(results)
 
 
 if __name__ == "__main__":